@@ -3,29 +3,203 @@
 Training Video Chatbot Demo Application
 """
 
-from flask import Flask, render_template, request, jsonify, session
+# Patch blocking I/O before anything else imports socket/ssl/threading
+from gevent import monkey
+monkey.patch_all()
+
+from flask import Flask, Response, render_template, request, jsonify, session, stream_with_context
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
 from openai import OpenAI
 from sqlalchemy import create_engine, text
+from contextlib import contextmanager
+import gevent
+import copy
 import json
+import orjson
+import ormsgpack
+import redis
 import uuid
+import time
 from datetime import datetime
 import os
+import re
+
+
+class ORJSONProvider(DefaultJSONProvider):
+    """Flask JSON provider backed by orjson"""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 
 app = Flask(__name__)
+app.json = ORJSONProvider(app)
 app.secret_key = os.getenv('SECRET_KEY', 'demo-secret-key')
 CORS(app)
 
 # Configuration
 OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
 DATABASE_URL = os.getenv('DATABASE_URL')
+REDIS_URL = os.getenv('REDIS_URL')
+# Only needed where idle connections get silently dropped (e.g. NAT resets)
+DB_POOL_PRE_PING = os.getenv('DB_POOL_PRE_PING', 'false').lower() == 'true'
+STATE_TTL_SECONDS = 86400
+TERMINAL_STATUSES = {'completed', 'recommendation_made'}
+PERSONA_CACHE_TTL_SECONDS = 300
+RECENT_MESSAGES_LIMIT = 6
+# MySQL connections shared by all gunicorn workers (MySQL's default max_connections is 151);
+# WEB_CONCURRENCY is exported by gunicorn.conf.py so each worker pool takes its share
+DB_MAX_CONNECTIONS = int(os.getenv('DB_MAX_CONNECTIONS', '100'))
+DB_CONNECTIONS_PER_WORKER = max(2, DB_MAX_CONNECTIONS // int(os.getenv('WEB_CONCURRENCY', '1')))
+DB_POOL_SIZE = max(1, DB_CONNECTIONS_PER_WORKER // 3)
 
 if not OPENAI_API_KEY:
     print("WARNING: OPENAI_API_KEY not set!")
 
+if not REDIS_URL:
+    print("WARNING: REDIS_URL not set, conversation state will be kept in MySQL")
+
 # Initialize clients
 openai_client = OpenAI(api_key=OPENAI_API_KEY) if OPENAI_API_KEY else None
-db_engine = create_engine(DATABASE_URL, pool_pre_ping=True)
+redis_client = redis.Redis.from_url(REDIS_URL) if REDIS_URL else None
+db_engine = create_engine(
+    DATABASE_URL,
+    pool_pre_ping=DB_POOL_PRE_PING,
+    pool_recycle=1800,
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_CONNECTIONS_PER_WORKER - DB_POOL_SIZE
+)
+
+
+def _dumps(obj):
+    """Serialize to a JSON string (text binds need str, not bytes)"""
+    return orjson.dumps(obj).decode()
+
+
+_loads = orjson.loads
+
+
+@contextmanager
+def _db_connection(conn=None):
+    """Reuse the caller's connection, or open one that commits on exit"""
+    if conn is not None:
+        yield conn
+    else:
+        with db_engine.begin() as new_conn:
+            yield new_conn
+
+
+# ============================================
+# SQL STATEMENTS
+# ============================================
+
+_SQL_INSERT_CONVERSATION = text("""
+    INSERT INTO conversations 
+    (conversation_id, user_id, status, state_json, exchange_count, completion_percentage)
+    VALUES (:conversation_id, :user_id, :status, :state_json, :exchange_count, :completion_percentage)
+""")
+
+_SQL_LOAD_CONVERSATION = text("""
+    SELECT state_json 
+    FROM conversations 
+    WHERE conversation_id = :conversation_id
+""")
+
+_SQL_RECENT_MESSAGES = text("""
+    SELECT speaker, message_content 
+    FROM conversation_messages 
+    WHERE conversation_id = :conversation_id
+    ORDER BY message_id DESC
+    LIMIT :limit
+""")
+
+_SQL_UPDATE_CONVERSATION = text("""
+    UPDATE conversations 
+    SET state_json = JSON_SET(
+            state_json,
+            '$.profile', CAST(:profile AS JSON),
+            '$.collected_fields', CAST(:collected_fields AS JSON),
+            '$.missing_fields', CAST(:missing_fields AS JSON),
+            '$.exchange_count', :exchange_count,
+            '$.completion_percentage', :completion_percentage,
+            '$.status', :status,
+            '$.matched_persona_id', :matched_persona_id,
+            '$.recommended_collection_id', :recommended_collection_id,
+            '$.confidence_score', :confidence_score
+        ),
+        last_activity_at = CURRENT_TIMESTAMP,
+        exchange_count = :exchange_count,
+        completion_percentage = :completion_percentage,
+        status = :status,
+        matched_persona_id = :matched_persona_id,
+        recommended_collection_id = :recommended_collection_id,
+        confidence_score = :confidence_score
+    WHERE conversation_id = :conversation_id
+""")
+
+_SQL_INSERT_MESSAGE = text("""
+    INSERT INTO conversation_messages 
+    (conversation_id, speaker, message_content, extracted_data)
+    VALUES (:conversation_id, :speaker, :message_content, :extracted_data)
+""")
+
+_SQL_ALL_PERSONAS = text("""
+    SELECT persona_id, name, description, characteristics, diagnostic_rules
+    FROM personas
+    ORDER BY persona_id
+""")
+
+_SQL_COLLECTION_WITH_VIDEOS = text("""
+    SELECT 
+        vc.collection_id,
+        vc.name,
+        vc.description,
+        vc.target_persona_id,
+        vc.total_videos,
+        vc.estimated_duration_minutes,
+        vc.learning_path_type,
+        p.name,
+        cv.sequence_position,
+        cv.is_required,
+        v.video_id,
+        v.title,
+        v.description,
+        v.youtube_url,
+        v.duration_minutes,
+        v.difficulty,
+        v.topic
+    FROM video_collections vc
+    JOIN personas p ON p.persona_id = vc.target_persona_id
+    LEFT JOIN collection_videos cv ON cv.collection_id = vc.collection_id
+    LEFT JOIN videos v ON v.video_id = cv.video_id
+    WHERE vc.target_persona_id = :persona_id AND vc.is_active = TRUE
+    ORDER BY vc.collection_id, cv.sequence_position
+""")
+
+_SQL_INSERT_USER_PROFILE = text("""
+    INSERT INTO user_profiles 
+    (user_id, conversation_id, role, experience_months, team_size, industry,
+     primary_challenges, learning_goals, time_available_hours_per_week,
+     emotional_state, urgency, matched_persona_id, assigned_collection_id,
+     confidence_score)
+    VALUES (:user_id, :conversation_id, :role, :experience_months, :team_size, :industry,
+            :primary_challenges, :learning_goals, :time_available_hours_per_week,
+            :emotional_state, :urgency, :matched_persona_id, :assigned_collection_id,
+            :confidence_score)
+""")
+
+_SQL_ENROLL_COLLECTION = text("""
+    INSERT INTO user_enrollments 
+    (user_id, video_id, collection_id, status)
+    SELECT :user_id, video_id, collection_id, 'enrolled'
+    FROM collection_videos 
+    WHERE collection_id = :collection_id
+    ORDER BY sequence_position
+""")
 
 
 # ============================================
@@ -35,15 +209,14 @@ db_engine = create_engine(DATABASE_URL, pool_pre_ping=True)
 class ConversationManager:
     """Manages conversation state and database operations"""
     
-    def __init__(self):
-        self.required_fields = [
-            'role',
-            'experience_months',
-            'primary_challenges',
-            'learning_goals'
-        ]
+    REQUIRED_FIELDS = (
+        'role',
+        'experience_months',
+        'primary_challenges',
+        'learning_goals'
+    )
     
-    def create_conversation(self, user_id=None):
+    def create_conversation(self, user_id=None, conn=None):
         """Initialize a new conversation"""
         conversation_id = str(uuid.uuid4())
         
@@ -63,104 +236,200 @@ class ConversationManager:
                 "urgency": None
             },
             "collected_fields": [],
-            "missing_fields": self.required_fields.copy(),
+            "missing_fields": list(self.REQUIRED_FIELDS),
             "messages": [],
             "exchange_count": 0,
             "completion_percentage": 0,
             "status": "active"
         }
         
-        with db_engine.connect() as conn:
-            conn.execute(text("""
-                INSERT INTO conversations 
-                (conversation_id, user_id, status, state_json, exchange_count, completion_percentage)
-                VALUES (:conversation_id, :user_id, :status, :state_json, :exchange_count, :completion_percentage)
-            """), {
+        with _db_connection(conn) as conn:
+            conn.execute(_SQL_INSERT_CONVERSATION, {
                 'conversation_id': conversation_id,
                 'user_id': initial_state["user_id"],
                 'status': 'active',
-                'state_json': json.dumps(initial_state),
+                'state_json': _dumps(self._persisted_state(initial_state)),
                 'exchange_count': 0,
                 'completion_percentage': 0
             })
-            conn.commit()
+        
+        if redis_client:
+            redis_client.set(
+                self._state_key(conversation_id),
+                ormsgpack.packb(self._persisted_state(initial_state)),
+                ex=STATE_TTL_SECONDS
+            )
         
         return initial_state
     
+    @staticmethod
+    def _persisted_state(conversation_state):
+        """State without the message history, which lives in conversation_messages"""
+        return {k: v for k, v in conversation_state.items() if k != 'messages'}
+    
+    @staticmethod
+    def _state_key(conversation_id):
+        return f"conv:{conversation_id}"
+    
+    @staticmethod
+    def _messages_key(conversation_id):
+        return f"msgs:{conversation_id}"
+    
     def load_conversation(self, conversation_id):
-        """Load conversation state from database"""
-        with db_engine.connect() as conn:
-            result = conn.execute(text("""
-                SELECT state_json 
-                FROM conversations 
-                WHERE conversation_id = :conversation_id
-            """), {'conversation_id': conversation_id})
-            
-            row = result.fetchone()
-            if row:
-                return json.loads(row[0])
-        return None
+        """Load conversation state and its recent messages from Redis, falling back to the database"""
+        conversation_state = None
+        messages = []
+        
+        if redis_client:
+            pipe = redis_client.pipeline()
+            pipe.get(self._state_key(conversation_id))
+            pipe.lrange(self._messages_key(conversation_id), -RECENT_MESSAGES_LIMIT, -1)
+            raw, raw_messages = pipe.execute()
+            if raw:
+                conversation_state = ormsgpack.unpackb(raw)
+            messages = [
+                {"role": m['speaker'], "content": m['message_content']}
+                for m in map(ormsgpack.unpackb, raw_messages)
+            ]
+        
+        if conversation_state is None or len(messages) < RECENT_MESSAGES_LIMIT:
+            with db_engine.connect() as conn:
+                if conversation_state is None:
+                    row = conn.execute(
+                        _SQL_LOAD_CONVERSATION,
+                        {'conversation_id': conversation_id}
+                    ).fetchone()
+                    if not row:
+                        return None
+                    conversation_state = _loads(row[0])
+                    # With Redis, MySQL only holds state as of creation or the last
+                    # terminal flush; an active conversation without its key has expired
+                    if redis_client and conversation_state['status'] not in TERMINAL_STATUSES:
+                        return None
+                
+                # Older history lives in the database (flushed, or never buffered)
+                result = conn.execute(_SQL_RECENT_MESSAGES, {
+                    'conversation_id': conversation_id,
+                    'limit': RECENT_MESSAGES_LIMIT - len(messages)
+                })
+                messages = [
+                    {"role": row[0], "content": row[1]}
+                    for row in reversed(result.fetchall())
+                ] + messages
+        
+        conversation_state['messages'] = messages
+        return conversation_state
     
-    def save_conversation(self, conversation_state):
-        """Save conversation state to database"""
-        with db_engine.connect() as conn:
-            conn.execute(text("""
-                UPDATE conversations 
-                SET state_json = :state_json,
-                    last_activity_at = CURRENT_TIMESTAMP,
-                    exchange_count = :exchange_count,
-                    completion_percentage = :completion_percentage,
-                    status = :status,
-                    matched_persona_id = :matched_persona_id,
-                    recommended_collection_id = :recommended_collection_id,
-                    confidence_score = :confidence_score
-                WHERE conversation_id = :conversation_id
-            """), {
-                'state_json': json.dumps(conversation_state),
-                'exchange_count': conversation_state['exchange_count'],
-                'completion_percentage': conversation_state['completion_percentage'],
-                'status': conversation_state['status'],
-                'matched_persona_id': conversation_state.get('matched_persona_id'),
-                'recommended_collection_id': conversation_state.get('recommended_collection_id'),
-                'confidence_score': conversation_state.get('confidence_score'),
-                'conversation_id': conversation_state['conversation_id']
-            })
-            conn.commit()
+    def save_conversation(self, conversation_state, conn=None):
+        """Save conversation state to Redis; flush to database on terminal states
+        
+        A caller passing its own conn must call finish_flush() with the returned
+        count once that transaction has committed.
+        """
+        if redis_client and conversation_state['status'] not in TERMINAL_STATUSES:
+            redis_client.set(
+                self._state_key(conversation_state['conversation_id']),
+                ormsgpack.packb(self._persisted_state(conversation_state)),
+                ex=STATE_TTL_SECONDS
+            )
+            return 0
+        
+        if conn is not None:
+            return self._flush_to_database(conversation_state, conn)
+        
+        with db_engine.begin() as conn:
+            flushed = self._flush_to_database(conversation_state, conn)
+        self.finish_flush(conversation_state, flushed)
+        return flushed
     
-    def save_message(self, conversation_id, speaker, content, extracted_data=None):
-        """Save individual message to database"""
-        with db_engine.connect() as conn:
-            conn.execute(text("""
-                INSERT INTO conversation_messages 
-                (conversation_id, speaker, message_content, extracted_data)
-                VALUES (:conversation_id, :speaker, :message_content, :extracted_data)
-            """), {
+    def _flush_to_database(self, conversation_state, conn):
+        """Write state and any buffered messages; returns how many messages were written"""
+        conversation_id = conversation_state['conversation_id']
+        buffered_messages = []
+        if redis_client:
+            buffered_messages = redis_client.lrange(self._messages_key(conversation_id), 0, -1)
+        
+        # Only rewrite the parts of state_json that change between turns
+        conn.execute(_SQL_UPDATE_CONVERSATION, {
+            'profile': _dumps(conversation_state['profile']),
+            'collected_fields': _dumps(conversation_state['collected_fields']),
+            'missing_fields': _dumps(conversation_state['missing_fields']),
+            'exchange_count': conversation_state['exchange_count'],
+            'completion_percentage': conversation_state['completion_percentage'],
+            'status': conversation_state['status'],
+            'matched_persona_id': conversation_state.get('matched_persona_id'),
+            'recommended_collection_id': conversation_state.get('recommended_collection_id'),
+            'confidence_score': conversation_state.get('confidence_score'),
+            'conversation_id': conversation_id
+        })
+        
+        if buffered_messages:
+            conn.execute(_SQL_INSERT_MESSAGE, [ormsgpack.unpackb(raw) for raw in buffered_messages])
+        
+        return len(buffered_messages)
+    
+    def finish_flush(self, conversation_state, flushed):
+        """After a flush has committed, update the Redis state and drop the written messages"""
+        if not redis_client:
+            return
+        
+        conversation_id = conversation_state['conversation_id']
+        pipe = redis_client.pipeline()
+        pipe.set(
+            self._state_key(conversation_id),
+            ormsgpack.packb(self._persisted_state(conversation_state)),
+            ex=STATE_TTL_SECONDS
+        )
+        if flushed:
+            # Messages pushed since the flush read the buffer stay queued
+            pipe.ltrim(self._messages_key(conversation_id), flushed, -1)
+        pipe.execute()
+    
+    def save_message(self, conversation_id, speaker, content, extracted_data=None, conn=None):
+        """Save individual message"""
+        self.save_messages(conversation_id, [(speaker, content, extracted_data)], conn=conn)
+    
+    def save_messages(self, conversation_id, messages, conn=None):
+        """Save a batch of (speaker, content, extracted_data) messages"""
+        rows = [
+            {
                 'conversation_id': conversation_id,
                 'speaker': speaker,
                 'message_content': content,
-                'extracted_data': json.dumps(extracted_data) if extracted_data else None
-            })
-            conn.commit()
+                'extracted_data': _dumps(extracted_data) if extracted_data else None
+            }
+            for speaker, content, extracted_data in messages
+        ]
+        
+        if redis_client:
+            messages_key = self._messages_key(conversation_id)
+            pipe = redis_client.pipeline()
+            pipe.rpush(messages_key, *map(ormsgpack.packb, rows))
+            pipe.expire(messages_key, STATE_TTL_SECONDS)
+            pipe.execute()
+            return
+        
+        # Without Redis the next turn reads its history from the database
+        with _db_connection(conn) as conn:
+            conn.execute(_SQL_INSERT_MESSAGE, rows)
     
     def update_completion_status(self, conversation_state):
         """Calculate what fields are collected vs missing"""
         profile = conversation_state['profile']
-        collected = []
-        missing = []
+        collected = [
+            field for field in self.REQUIRED_FIELDS
+            if profile.get(field) not in (None, [], "")
+        ]
         
-        for field in self.required_fields:
-            value = profile.get(field)
-            
-            if value is not None and value != [] and value != "":
-                collected.append(field)
-            else:
-                missing.append(field)
+        if len(collected) == len(self.REQUIRED_FIELDS):
+            missing = []
+        else:
+            collected_set = set(collected)
+            missing = [field for field in self.REQUIRED_FIELDS if field not in collected_set]
         
         conversation_state['collected_fields'] = collected
         conversation_state['missing_fields'] = missing
-        conversation_state['completion_percentage'] = int(
-            (len(collected) / len(self.required_fields)) * 100
-        )
+        conversation_state['completion_percentage'] = len(collected) * 100 // len(self.REQUIRED_FIELDS)
         
         return conversation_state
 
@@ -169,20 +438,36 @@ class ConversationManager:
 # AI SERVICE
 # ============================================
 
-class AIService:
-    """Handles all AI-related operations"""
+# Prompts keep their invariant instructions in a leading system message so
+# OpenAI prompt caching can reuse that prefix; per-turn data comes after it.
+
+PICK_PERSONA_TOOL = {
+    "type": "function",
+    "function": {
+        "name": "pick_persona",
+        "description": "Record the persona that best matches the user profile",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "matched_persona_id": {"type": "string"},
+                "confidence_score": {"type": "integer", "minimum": 0, "maximum": 100},
+                "reasoning": {"type": "string"}
+            },
+            "required": ["matched_persona_id", "confidence_score", "reasoning"]
+        }
+    }
+}
 
-    def __init__(self, client):
-        self.client = client
-        self.model = "gpt-4o"
-    
-    def extract_profile_info(self, user_message, current_profile):
-        """Extract structured profile information from user's message"""
-        
-        if not self.client:
-            return {}
-        
-        system_prompt = """You are a data extraction assistant. Extract relevant profile information from the user's message.
+# Role keyword buckets for the offline persona fallback, matched in one scan
+ROLE_KEYWORDS_RE = re.compile(
+    r'(?P<manager>manager|team lead|supervisor)'
+    r'|(?P<technical>engineer|developer|technical)'
+    r'|(?P<hr>hr|human resources|recruiter)'
+    r'|(?P<sales>sales|account|business development)'
+)
+
+
+EXTRACTION_SYSTEM_PROMPT = """You are a data extraction assistant. Extract relevant profile information from the user's message.
 
 Return ONLY information that is clearly stated or strongly implied. If information is ambiguous or not present, return null for that field.
 
@@ -201,6 +486,58 @@ Return in this exact JSON format:
 
 Be conservative - only extract what you're confident about."""
 
+PERSONA_MATCH_SYSTEM_PROMPT = """You are an expert at matching user profiles to learning personas.
+
+Given a user profile and available personas, determine the best match and explain why.
+
+Record your answer with the pick_persona tool: the matched persona ID, a confidence score from 0 to 100, and a brief explanation of why this persona matches."""
+
+NEXT_QUESTION_SYSTEM_PROMPT = """You are Videa, a warm and empathetic training advisor for a professional training company.
+
+CONVERSATION RULES:
+1. Be warm, empathetic, and conversational
+2. Ask ONE question at a time
+3. Don't ask about information you already know
+4. Match the emotional tone of the user
+5. If user seems stressed, acknowledge it before asking
+6. Keep questions brief and natural
+7. Keep an eye on the exchange count - we need to wrap up soon
+
+YOUR TASK:
+Generate your next message to the user. Either:
+- Ask about the next missing field naturally, OR
+- If exchange count > 8, gently suggest moving to recommendations
+
+Keep it conversational and human."""
+
+NEXT_QUESTION_CONTEXT_TEMPLATE = """CONVERSATION CONTEXT:
+{history}
+
+PROFILE INFORMATION COLLECTED SO FAR:
+{profile}
+
+STILL NEED TO LEARN ABOUT:
+{missing}
+
+EXCHANGE COUNT: {exchange_count}"""
+
+NEXT_QUESTION_FALLBACK = "Could you tell me a bit more about what you're looking for?"
+
+
+class AIService:
+    """Handles all AI-related operations"""
+
+    def __init__(self, client):
+        self.client = client
+        self.model = "gpt-4o"
+        self.extraction_model = "gpt-4o-mini"
+    
+    def extract_profile_info(self, user_message, current_profile):
+        """Extract structured profile information from user's message"""
+        
+        if not self.client:
+            return {}
+        
         user_prompt = f"""Current profile state:
 {json.dumps(current_profile, indent=2)}
 
@@ -211,34 +548,24 @@ Extract any new or updated information from this message."""
 
         try:
             response = self.client.chat.completions.create(
-                model=self.model,
+                model=self.extraction_model,
                 max_tokens=1024,
+                response_format={"type": "json_object"},
                 messages=[
-                    {"role": "system", "content": system_prompt},
+                    {"role": "system", "content": EXTRACTION_SYSTEM_PROMPT},
                     {"role": "user", "content": user_prompt}
                 ]
             )
 
-            extracted_text = response.choices[0].message.content
-
-            if "```json" in extracted_text:
-                extracted_text = extracted_text.split("```json")[1].split("```")[0].strip()
-            elif "```" in extracted_text:
-                extracted_text = extracted_text.split("```")[1].split("```")[0].strip()
-
-            extracted_data = json.loads(extracted_text)
+            extracted_data = _loads(response.choices[0].message.content)
             return extracted_data
 
         except Exception as e:
             print(f"Error in extraction: {e}")
             return {}
     
-    def generate_next_question(self, conversation_state):
-        """Generate natural next question based on conversation state"""
-        
-        if not self.client:
-            return "Could you tell me more about your background and what you're looking for?"
-        
+    def _next_question_messages(self, conversation_state):
+        """Build the chat messages used to generate the next question"""
         profile = conversation_state['profile']
         missing = conversation_state['missing_fields']
         messages = conversation_state['messages']
@@ -246,7 +573,7 @@ Extract any new or updated information from this message."""
         
         message_history = "\n".join([
             f"{msg['role'].upper()}: {msg['content']}"
-            for msg in messages[-6:]
+            for msg in messages[-RECENT_MESSAGES_LIMIT:]
         ])
         
         profile_summary = "\n".join([
@@ -257,42 +584,31 @@ Extract any new or updated information from this message."""
         
         missing_fields_text = ", ".join(missing) if missing else "None - all information collected!"
         
-        system_prompt = f"""You are Videa, a warm and empathetic training advisor for a professional training company.
-
-CONVERSATION CONTEXT:
-{message_history}
-
-PROFILE INFORMATION COLLECTED SO FAR:
-{profile_summary if profile_summary else "(Nothing collected yet)"}
-
-STILL NEED TO LEARN ABOUT:
-{missing_fields_text}
-
-CONVERSATION RULES:
-1. Be warm, empathetic, and conversational
-2. Ask ONE question at a time
-3. Don't ask about information you already know
-4. Match the emotional tone of the user
-5. If user seems stressed, acknowledge it before asking
-6. Keep questions brief and natural
-7. After {exchange_count} exchanges, we need to wrap up soon
-
-YOUR TASK:
-Generate your next message to the user. Either:
-- Ask about the next missing field naturally, OR
-- If exchange count > 8, gently suggest moving to recommendations
-
-Keep it conversational and human."""
+        context_prompt = NEXT_QUESTION_CONTEXT_TEMPLATE.format_map({
+            'history': message_history,
+            'profile': profile_summary or "(Nothing collected yet)",
+            'missing': missing_fields_text,
+            'exchange_count': exchange_count
+        })
 
+        return [
+            {"role": "system", "content": NEXT_QUESTION_SYSTEM_PROMPT},
+            {"role": "system", "content": context_prompt},
+            {"role": "user", "content": "Generate your next message to the user."}
+        ]
+    
+    def generate_next_question(self, conversation_state):
+        """Generate natural next question based on conversation state"""
+        
+        if not self.client:
+            return "Could you tell me more about your background and what you're looking for?"
+        
         try:
             response = self.client.chat.completions.create(
                 model=self.model,
                 max_tokens=300,
                 temperature=0.7,
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": "Generate your next message to the user."}
-                ]
+                messages=self._next_question_messages(conversation_state)
             )
 
             bot_message = response.choices[0].message.content.strip()
@@ -300,7 +616,36 @@ Keep it conversational and human."""
 
         except Exception as e:
             print(f"Error generating question: {e}")
-            return "Could you tell me a bit more about what you're looking for?"
+            return NEXT_QUESTION_FALLBACK
+    
+    def stream_next_question(self, conversation_state):
+        """Generate the next question, yielding text chunks as they arrive"""
+        
+        if not self.client:
+            yield "Could you tell me more about your background and what you're looking for?"
+            return
+        
+        started = False
+        try:
+            stream = self.client.chat.completions.create(
+                model=self.model,
+                max_tokens=300,
+                temperature=0.7,
+                stream=True,
+                messages=self._next_question_messages(conversation_state)
+            )
+
+            for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    started = True
+                    yield chunk.choices[0].delta.content
+
+        except Exception as e:
+            print(f"Error streaming question: {e}")
+            # Partial text has already gone out; let the caller replace it
+            if started:
+                raise
+            yield NEXT_QUESTION_FALLBACK
     
     def match_persona(self, profile, personas_data):
         """Match profile to best persona using AI"""
@@ -309,17 +654,6 @@ Keep it conversational and human."""
             # Fallback: simple keyword matching
             return self._simple_persona_match(profile, personas_data)
         
-        system_prompt = """You are an expert at matching user profiles to learning personas.
-
-Given a user profile and available personas, determine the best match and explain why.
-
-Return in this JSON format:
-{
-    "matched_persona_id": "persona_001",
-    "confidence_score": 85,
-    "reasoning": "Brief explanation of why this persona matches"
-}"""
-
         personas_summary = "\n\n".join([
             f"Persona ID: {p['persona_id']}\nName: {p['name']}\nDescription: {p['description']}"
             for p in personas_data
@@ -328,26 +662,23 @@ Return in this JSON format:
         user_prompt = f"""User Profile:
 {json.dumps(profile, indent=2)}
 
-Available Personas:
-{personas_summary}
-
 Determine the best matching persona."""
 
         try:
             response = self.client.chat.completions.create(
                 model=self.model,
                 max_tokens=500,
+                tools=[PICK_PERSONA_TOOL],
+                tool_choice={"type": "function", "function": {"name": "pick_persona"}},
                 messages=[
-                    {"role": "system", "content": system_prompt},
+                    {"role": "system", "content": PERSONA_MATCH_SYSTEM_PROMPT},
+                    {"role": "system", "content": f"Available Personas:\n{personas_summary}"},
                     {"role": "user", "content": user_prompt}
                 ]
             )
 
-            result_text = response.choices[0].message.content
-            if "```json" in result_text:
-                result_text = result_text.split("```json")[1].split("```")[0].strip()
-
-            match_result = json.loads(result_text)
+            tool_call = response.choices[0].message.tool_calls[0]
+            match_result = _loads(tool_call.function.arguments)
             return match_result
 
         except Exception as e:
@@ -358,9 +689,10 @@ Determine the best matching persona."""
         """Simple fallback persona matching based on keywords"""
         role = profile.get('role', '').lower() if profile.get('role') else ''
         experience = profile.get('experience_months', 0) or 0
+        role_buckets = {m.lastgroup for m in ROLE_KEYWORDS_RE.finditer(role)}
         
         # Simple matching logic
-        if 'manager' in role or 'team lead' in role or 'supervisor' in role:
+        if 'manager' in role_buckets:
             if experience < 24:
                 return {
                     'matched_persona_id': 'persona_001',
@@ -368,7 +700,7 @@ Determine the best matching persona."""
                     'reasoning': 'New manager with limited experience'
                 }
         
-        if 'engineer' in role or 'developer' in role or 'technical' in role:
+        if 'technical' in role_buckets:
             if experience >= 60:
                 return {
                     'matched_persona_id': 'persona_002',
@@ -376,14 +708,14 @@ Determine the best matching persona."""
                     'reasoning': 'Senior technical professional'
                 }
         
-        if 'hr' in role or 'human resources' in role or 'recruiter' in role:
+        if 'hr' in role_buckets:
             return {
                 'matched_persona_id': 'persona_004',
                 'confidence_score': 85,
                 'reasoning': 'HR professional'
             }
         
-        if 'sales' in role or 'account' in role or 'business development' in role:
+        if 'sales' in role_buckets:
             return {
                 'matched_persona_id': 'persona_005',
                 'confidence_score': 80,
@@ -411,14 +743,13 @@ Determine the best matching persona."""
 # ============================================
 
 class PersonaService:
+    # Personas are static reference data, so keep them in-process for a while
+    _cache = {'personas': None, 'loaded_at': 0}
+    
     @staticmethod
-    def get_all_personas():
+    def _load_personas():
         with db_engine.connect() as conn:
-            result = conn.execute(text("""
-                SELECT persona_id, name, description, characteristics, diagnostic_rules
-                FROM personas
-                ORDER BY persona_id
-            """))
+            result = conn.execute(_SQL_ALL_PERSONAS)
             
             personas = []
             for row in result:
@@ -426,87 +757,61 @@ class PersonaService:
                     'persona_id': row[0],
                     'name': row[1],
                     'description': row[2],
-                    'characteristics': json.loads(row[3]) if row[3] else {},
-                    'diagnostic_rules': json.loads(row[4]) if row[4] else {}
+                    'characteristics': _loads(row[3]) if row[3] else {},
+                    'diagnostic_rules': _loads(row[4]) if row[4] else {}
                 })
             return personas
     
-    @staticmethod
-    def get_persona_by_id(persona_id):
-        with db_engine.connect() as conn:
-            result = conn.execute(text("""
-                SELECT * FROM personas WHERE persona_id = :persona_id
-            """), {'persona_id': persona_id})
-            
-            row = result.fetchone()
-            if row:
-                return {
-                    'persona_id': row[0],
-                    'name': row[1],
-                    'description': row[2],
-                    'characteristics': json.loads(row[3]) if row[3] else {},
-                    'diagnostic_rules': json.loads(row[4]) if row[4] else {}
-                }
-        return None
+    @classmethod
+    def get_all_personas(cls):
+        cache = cls._cache
+        if cache['personas'] is None or \
+                time.time() - cache['loaded_at'] >= PERSONA_CACHE_TTL_SECONDS:
+            personas = cls._load_personas()
+            cls._cache = {
+                'personas': personas,
+                'loaded_at': time.time()
+            }
+        return cls._cache['personas']
 
 
 class CollectionService:
     @staticmethod
-    def get_collection_by_persona(persona_id):
-        with db_engine.connect() as conn:
-            result = conn.execute(text("""
-                SELECT * FROM video_collections 
-                WHERE target_persona_id = :persona_id AND is_active = TRUE
-                LIMIT 1
-            """), {'persona_id': persona_id})
-            
-            row = result.fetchone()
-            if row:
-                return {
-                    'collection_id': row[0],
-                    'name': row[1],
-                    'description': row[2],
-                    'target_persona_id': row[3],
-                    'total_videos': row[4],
-                    'estimated_duration_minutes': row[5],
-                    'learning_path_type': row[6]
-                }
-        return None
-    
-    @staticmethod
-    def get_collection_videos(collection_id):
+    def get_collection_with_videos(persona_id):
+        """Load a persona's active collection, its persona name and its videos in one query"""
         with db_engine.connect() as conn:
-            result = conn.execute(text("""
-                SELECT 
-                    cv.sequence_position,
-                    cv.is_required,
-                    v.video_id,
-                    v.title,
-                    v.description,
-                    v.youtube_url,
-                    v.duration_minutes,
-                    v.difficulty,
-                    v.topic
-                FROM collection_videos cv
-                JOIN videos v ON cv.video_id = v.video_id
-                WHERE cv.collection_id = :collection_id
-                ORDER BY cv.sequence_position
-            """), {'collection_id': collection_id})
+            result = conn.execute(_SQL_COLLECTION_WITH_VIDEOS, {'persona_id': persona_id})
             
-            videos = []
+            collection = None
             for row in result:
-                videos.append({
-                    'sequence_position': row[0],
-                    'is_required': row[1],
-                    'video_id': row[2],
-                    'title': row[3],
-                    'description': row[4],
-                    'youtube_url': row[5],
-                    'duration_minutes': row[6],
-                    'difficulty': row[7],
-                    'topic': row[8]
-                })
-            return videos
+                if collection is None:
+                    collection = {
+                        'collection_id': row[0],
+                        'name': row[1],
+                        'description': row[2],
+                        'target_persona_id': row[3],
+                        'total_videos': row[4],
+                        'estimated_duration_minutes': row[5],
+                        'learning_path_type': row[6],
+                        'persona_name': row[7],
+                        'videos': []
+                    }
+                elif row[0] != collection['collection_id']:
+                    break
+                
+                if row[10] is not None:
+                    collection['videos'].append({
+                        'sequence_position': row[8],
+                        'is_required': row[9],
+                        'video_id': row[10],
+                        'title': row[11],
+                        'description': row[12],
+                        'youtube_url': row[13],
+                        'duration_minutes': row[14],
+                        'difficulty': row[15],
+                        'topic': row[16]
+                    })
+            return collection
 
 
 # Initialize services
@@ -518,6 +823,9 @@ ai_service = AIService(openai_client)
 # ROUTES
 # ============================================
 
+INITIAL_MESSAGE = "Hi! I'm Videa, your personal training advisor. I'm here to help you find the perfect learning path for your professional development. Tell me, what brings you here today? What are you hoping to learn or improve?"
+
+
 @app.route('/')
 def index():
     """Main page with chat interface"""
@@ -528,42 +836,37 @@ def index():
 def start_chat():
     """Initialize a new conversation"""
     data = request.json or {}
+    if not isinstance(data, dict):
+        return jsonify({"error": "Request body must be a JSON object"}), 400
     user_id = data.get('user_id')
     
-    conversation_state = conversation_manager.create_conversation(user_id)
-    
-    initial_message = {
-        "role": "assistant",
-        "content": "Hi! I'm Videa, your personal training advisor. I'm here to help you find the perfect learning path for your professional development. Tell me, what brings you here today? What are you hoping to learn or improve?"
-    }
-    
-    conversation_state['messages'].append(initial_message)
-    conversation_manager.save_conversation(conversation_state)
-    conversation_manager.save_message(
-        conversation_state['conversation_id'],
-        'assistant',
-        initial_message['content']
-    )
+    # The conversation row and (without Redis) its greeting commit together
+    with db_engine.begin() as conn:
+        conversation_state = conversation_manager.create_conversation(user_id, conn=conn)
+        conversation_manager.save_message(
+            conversation_state['conversation_id'],
+            'assistant',
+            INITIAL_MESSAGE,
+            conn=conn
+        )
     
     return jsonify({
         "conversation_id": conversation_state['conversation_id'],
-        "message": initial_message['content']
+        "message": INITIAL_MESSAGE
     })
 
 
-@app.route('/api/chat/message', methods=['POST'])
-def handle_message():
-    """Process user message and generate response"""
-    data = request.json
+def _begin_turn(data):
+    """Validate a chat message request and apply the user's message to the state"""
     conversation_id = data.get('conversation_id')
     user_message = data.get('message')
     
     if not conversation_id or not user_message:
-        return jsonify({"error": "Missing conversation_id or message"}), 400
+        return None, (jsonify({"error": "Missing conversation_id or message"}), 400)
     
     conversation_state = conversation_manager.load_conversation(conversation_id)
     if not conversation_state:
-        return jsonify({"error": "Conversation not found"}), 404
+        return None, (jsonify({"error": "Conversation not found"}), 404)
     
     # Add user message
     conversation_state['messages'].append({
@@ -572,57 +875,62 @@ def handle_message():
     })
     conversation_state['exchange_count'] += 1
     
-    conversation_manager.save_message(conversation_id, 'user', user_message)
-    
-    # Extract information
-    extracted_data = ai_service.extract_profile_info(
-        user_message,
-        conversation_state['profile']
-    )
-    
-    # Update profile
+    return conversation_state, None
+
+
+def _apply_extracted_data(conversation_state, extracted_data):
+    """Merge extracted profile information and refresh completion status"""
     for key, value in extracted_data.items():
         if value is not None:
             if isinstance(value, list) and isinstance(conversation_state['profile'].get(key), list):
+                # Append only new items, keeping the order they were mentioned in
                 existing = conversation_state['profile'][key]
-                conversation_state['profile'][key] = list(set(existing + value))
+                seen = set(existing)
+                for item in value:
+                    if item not in seen:
+                        seen.add(item)
+                        existing.append(item)
             else:
                 conversation_state['profile'][key] = value
     
-    # Update completion status
-    conversation_state = conversation_manager.update_completion_status(conversation_state)
-    
-    # Determine next action
-    should_recommend = (
+    return conversation_manager.update_completion_status(conversation_state)
+
+
+def _should_recommend(conversation_state):
+    return (
         conversation_state['completion_percentage'] >= 60 or
         conversation_state['exchange_count'] >= 10
     )
+
+
+def _build_recommendation(conversation_state):
+    """Match a persona and collection and return the recommendation message"""
+    personas = PersonaService.get_all_personas()
+    match_result = ai_service.match_persona(
+        conversation_state['profile'],
+        personas
+    )
     
-    if should_recommend:
-        # Generate recommendation
-        personas = PersonaService.get_all_personas()
-        match_result = ai_service.match_persona(
-            conversation_state['profile'],
-            personas
-        )
-        
-        if match_result:
-            persona_id = match_result['matched_persona_id']
-            confidence_score = match_result['confidence_score']
-            
-            persona = PersonaService.get_persona_by_id(persona_id)
-            collection = CollectionService.get_collection_by_persona(persona_id)
-            
-            if collection:
-                videos = CollectionService.get_collection_videos(collection['collection_id'])
-                
-                # Format video list
-                video_list = "\n".join([
-                    f"  {i+1}. {v['title']} ({v['duration_minutes']} min)"
-                    for i, v in enumerate(videos)
-                ])
-                
-                bot_message = f"""Based on everything you've shared, I believe you match the **{persona['name']}** profile.
+    if not match_result:
+        return "Based on what you've told me, let me connect you with a human advisor who can provide personalized recommendations."
+    
+    persona_id = match_result['matched_persona_id']
+    confidence_score = match_result['confidence_score']
+    
+    collection = CollectionService.get_collection_with_videos(persona_id)
+    
+    if not collection:
+        return "I have a good sense of what you need, but I'm having trouble finding the perfect collection. Let me connect you with a human advisor who can help."
+    
+    videos = collection['videos']
+    
+    # Format video list
+    video_list = "\n".join([
+        f"  {i+1}. {v['title']} ({v['duration_minutes']} min)"
+        for i, v in enumerate(videos)
+    ])
+    
+    bot_message = f"""Based on everything you've shared, I believe you match the **{collection['persona_name']}** profile.
 
 {match_result['reasoning']}
 
@@ -635,18 +943,18 @@ I recommend our **{collection['name']}** learning path:
 This collection is designed to {collection['description'].lower()}.
 
 Would you like to enroll in this learning path?"""
-                
-                conversation_state['status'] = 'recommendation_made'
-                conversation_state['matched_persona_id'] = persona_id
-                conversation_state['recommended_collection_id'] = collection['collection_id']
-                conversation_state['confidence_score'] = confidence_score
-            else:
-                bot_message = "I have a good sense of what you need, but I'm having trouble finding the perfect collection. Let me connect you with a human advisor who can help."
-        else:
-            bot_message = "Based on what you've told me, let me connect you with a human advisor who can provide personalized recommendations."
-    else:
-        # Continue conversation
-        bot_message = ai_service.generate_next_question(conversation_state)
+    
+    conversation_state['status'] = 'recommendation_made'
+    conversation_state['matched_persona_id'] = persona_id
+    conversation_state['recommended_collection_id'] = collection['collection_id']
+    conversation_state['confidence_score'] = confidence_score
+    
+    return bot_message
+
+
+def _finish_turn(conversation_state, user_message, bot_message, extracted_data):
+    """Record the bot response, persist the turn and return the response payload"""
+    conversation_id = conversation_state['conversation_id']
     
     # Add bot response
     conversation_state['messages'].append({
@@ -654,27 +962,133 @@ Would you like to enroll in this learning path?"""
         "content": bot_message
     })
     
-    # Save everything
-    conversation_manager.save_conversation(conversation_state)
-    conversation_manager.save_message(
-        conversation_id,
-        'assistant',
-        bot_message,
-        extracted_data
-    )
+    turn_messages = [
+        ('user', user_message, None),
+        ('assistant', bot_message, extracted_data)
+    ]
     
-    return jsonify({
+    if redis_client and conversation_state['status'] not in TERMINAL_STATUSES:
+        # The turn stays in Redis until the conversation is flushed
+        conversation_manager.save_messages(conversation_id, turn_messages)
+        conversation_manager.save_conversation(conversation_state)
+    else:
+        # Messages and state commit together (messages first so a terminal flush includes them)
+        with db_engine.begin() as conn:
+            conversation_manager.save_messages(conversation_id, turn_messages, conn=conn)
+            flushed = conversation_manager.save_conversation(conversation_state, conn=conn)
+        conversation_manager.finish_flush(conversation_state, flushed)
+    
+    return {
         "message": bot_message,
         "completion_percentage": conversation_state['completion_percentage'],
         "status": conversation_state.get('status', 'active'),
         "exchange_count": conversation_state['exchange_count']
-    })
+    }
+
+
+def _sse(payload):
+    """Format a payload as a server-sent event"""
+    return f"data: {_dumps(payload)}\n\n"
+
+
+@app.route('/api/chat/message', methods=['POST'])
+def handle_message():
+    """Process user message and generate response"""
+    data = request.json
+    if not isinstance(data, dict):
+        return jsonify({"error": "Request body must be a JSON object"}), 400
+    conversation_state, error = _begin_turn(data)
+    if error:
+        return error
+    user_message = data['message']
+    
+    # Speculatively generate the next question in its own greenlet while
+    # extraction runs; it is discarded if extraction fills a missing field
+    # or the turn ends in a recommendation
+    next_question = None
+    missing_before = list(conversation_state['missing_fields'])
+    if conversation_state['exchange_count'] < 10:
+        next_question = gevent.spawn(
+            ai_service.generate_next_question,
+            {**conversation_state, 'profile': copy.deepcopy(conversation_state['profile'])}
+        )
+    
+    # Extract information
+    extracted_data = ai_service.extract_profile_info(
+        user_message,
+        conversation_state['profile']
+    )
+    conversation_state = _apply_extracted_data(conversation_state, extracted_data)
+    
+    # Determine next action
+    if _should_recommend(conversation_state):
+        if next_question:
+            next_question.kill(block=False)
+        bot_message = _build_recommendation(conversation_state)
+    elif conversation_state['missing_fields'] != missing_before:
+        # The speculative prompt still asks about fields this message just answered
+        next_question.kill(block=False)
+        bot_message = ai_service.generate_next_question(conversation_state)
+    else:
+        # Continue conversation
+        bot_message = next_question.get()
+    
+    return jsonify(_finish_turn(conversation_state, user_message, bot_message, extracted_data))
+
+
+@app.route('/api/chat/stream', methods=['POST'])
+def stream_message():
+    """Process user message and stream the response as server-sent events"""
+    data = request.json
+    if not isinstance(data, dict):
+        return jsonify({"error": "Request body must be a JSON object"}), 400
+    conversation_state, error = _begin_turn(data)
+    if error:
+        return error
+    user_message = data['message']
+    
+    # Extract information
+    extracted_data = ai_service.extract_profile_info(
+        user_message,
+        conversation_state['profile']
+    )
+    conversation_state = _apply_extracted_data(conversation_state, extracted_data)
+    
+    def generate():
+        try:
+            if _should_recommend(conversation_state):
+                bot_message = _build_recommendation(conversation_state)
+                yield _sse({"delta": bot_message})
+            else:
+                chunks = []
+                try:
+                    for delta in ai_service.stream_next_question(conversation_state):
+                        chunks.append(delta)
+                        yield _sse({"delta": delta})
+                    bot_message = "".join(chunks).strip()
+                except Exception:
+                    # The reply broke off mid-stream; replace what was sent with the fallback
+                    bot_message = NEXT_QUESTION_FALLBACK
+                    yield _sse({"replace": bot_message})
+            
+            result = _finish_turn(conversation_state, user_message, bot_message, extracted_data)
+        except Exception as e:
+            # Headers are already sent, so report the failure in-band
+            print(f"Error streaming message: {e}")
+            yield _sse({"error": "Something went wrong while generating the reply"})
+            return
+        
+        yield _sse({"done": True, **result})
+    
+    return Response(stream_with_context(generate()), mimetype='text/event-stream')
 
 
 @app.route('/api/chat/confirm', methods=['POST'])
 def confirm_recommendation():
     """User confirms the recommendation"""
     data = request.json
+    if not isinstance(data, dict):
+        return jsonify({"error": "Request body must be a JSON object"}), 400
     conversation_id = data.get('conversation_id')
     confirmed = data.get('confirmed', False)
     
@@ -689,18 +1103,8 @@ def confirm_recommendation():
         # Create user profile record
         profile = conversation_state['profile']
         
-        with db_engine.connect() as conn:
-            conn.execute(text("""
-                INSERT INTO user_profiles 
-                (user_id, conversation_id, role, experience_months, team_size, industry,
-                 primary_challenges, learning_goals, time_available_hours_per_week,
-                 emotional_state, urgency, matched_persona_id, assigned_collection_id,
-                 confidence_score)
-                VALUES (:user_id, :conversation_id, :role, :experience_months, :team_size, :industry,
-                        :primary_challenges, :learning_goals, :time_available_hours_per_week,
-                        :emotional_state, :urgency, :matched_persona_id, :assigned_collection_id,
-                        :confidence_score)
-            """), {
+        with db_engine.begin() as conn:
+            conn.execute(_SQL_INSERT_USER_PROFILE, {
                 'user_id': conversation_state['user_id'],
                 'conversation_id': conversation_id,
                 'role': profile.get('role'),
@@ -717,31 +1121,18 @@ def confirm_recommendation():
                 'confidence_score': conversation_state.get('confidence_score')
             })
             
-            # Get videos in the collection
-            collection_id = conversation_state['recommended_collection_id']
-            result = conn.execute(text("""
-                SELECT video_id FROM collection_videos 
-                WHERE collection_id = :collection_id
-                ORDER BY sequence_position
-            """), {'collection_id': collection_id})
-            
-            # Enroll user in each video
-            for row in result:
-                conn.execute(text("""
-                    INSERT INTO user_enrollments 
-                    (user_id, video_id, collection_id, status)
-                    VALUES (:user_id, :video_id, :collection_id, 'enrolled')
-                """), {
-                    'user_id': conversation_state['user_id'],
-                    'video_id': row[0],
-                    'collection_id': collection_id
-                })
+            # Enroll user in every video of the collection in one statement
+            conn.execute(_SQL_ENROLL_COLLECTION, {
+                'user_id': conversation_state['user_id'],
+                'collection_id': conversation_state['recommended_collection_id']
+            })
             
-            conn.commit()
+            # Update conversation status
+            conversation_state['status'] = 'completed'
+            flushed = conversation_manager.save_conversation(conversation_state, conn=conn)
         
-        # Update conversation status
-        conversation_state['status'] = 'completed'
-        conversation_manager.save_conversation(conversation_state)
+        # Only clear the Redis buffer once the transaction has committed
+        conversation_manager.finish_flush(conversation_state, flushed)
         
         return jsonify({
             "success": True,
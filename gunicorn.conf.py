@@ -0,0 +1,27 @@
+"""
+Gunicorn configuration for serving the chatbot
+"""
+
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '5000')}"
+
+# The app spends nearly all its time waiting on OpenAI, MySQL and Redis,
+# so cooperative gevent workers let many requests overlap per process
+workers = int(os.getenv('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+worker_class = 'gevent'
+worker_connections = 1000
+
+# Each worker has its own MySQL pool; app.py sizes it from the worker count
+# so all workers together stay within DB_MAX_CONNECTIONS
+os.environ['WEB_CONCURRENCY'] = str(workers)
+
+# With gevent workers `timeout` is only a heartbeat, not a per-request limit,
+# so long streamed replies are fine at the default. On restart, give in-flight
+# streams time to finish before the worker is killed
+graceful_timeout = 30
+keepalive = 5
+
+accesslog = '-'
+errorlog = '-'
\ No newline at end of file
@@ -124,6 +124,30 @@ function addMessage(speaker, content) {
     
     chatMessages.appendChild(messageDiv);
     chatMessages.scrollTop = chatMessages.scrollHeight;
+    
+    return contentDiv;
+}
+
+// Read server-sent events from a streaming response
+async function readEventStream(response, onEvent) {
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    
+    while (true) {
+        const { done, value } = await reader.read();
+        if (done) break;
+        
+        buffer += decoder.decode(value, { stream: true });
+        const events = buffer.split('\n\n');
+        buffer = events.pop();
+        
+        for (const event of events) {
+            if (event.startsWith('data: ')) {
+                onEvent(JSON.parse(event.slice(6)));
+            }
+        }
+    }
 }
 
 // Show typing indicator
@@ -169,7 +193,7 @@ async function sendMessage() {
     showTyping();
     
     try {
-        const response = await fetch(`${API_BASE_URL}/chat/message`, {
+        const response = await fetch(`${API_BASE_URL}/chat/stream`, {
             method: 'POST',
             headers: {
                 'Content-Type': 'application/json'
@@ -179,20 +203,60 @@ async function sendMessage() {
                 message: message
             })
         });
-
-        const data = await response.json();
         
-        // Hide typing indicator
+        if (!response.ok) {
+            throw new Error(`Request failed with status ${response.status}`);
+        }
+        
+        let contentDiv = null;
+        let finalData = null;
+        let streamError = null;
+        
+        await readEventStream(response, (event) => {
+            if (event.error) {
+                streamError = event.error;
+                return;
+            }
+            if (event.done) {
+                finalData = event;
+                return;
+            }
+            
+            // Replace typing indicator with the bot response as it streams in
+            if (!contentDiv) {
+                hideTyping();
+                contentDiv = addMessage('assistant', '');
+            }
+            if (event.replace !== undefined) {
+                // The stream failed part-way; the server sent a replacement reply
+                contentDiv.textContent = event.replace;
+            } else {
+                contentDiv.textContent += event.delta;
+            }
+            chatMessages.scrollTop = chatMessages.scrollHeight;
+        });
+        
         hideTyping();
         
-        // Add bot response
-        addMessage('assistant', data.message);
+        // No done event means the turn was not saved; drop any partial reply
+        if (streamError || !finalData) {
+            if (contentDiv) {
+                contentDiv.parentElement.remove();
+            }
+            throw new Error(streamError || 'Stream ended without a reply');
+        }
+        
+        if (contentDiv) {
+            contentDiv.textContent = finalData.message;
+        } else {
+            addMessage('assistant', finalData.message);
+        }
         
         // Update progress
-        updateProgress(data.completion_percentage || 0);
+        updateProgress(finalData.completion_percentage || 0);
         
         // Check if recommendation was made
-        if (data.status === 'recommendation_made') {
+        if (finalData.status === 'recommendation_made') {
             awaitingConfirmation = true;
             addConfirmationButtons();
         }